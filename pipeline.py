@@ -0,0 +1,194 @@
+# pipeline.py
+# 모델 로드/전처리/예측 공용 코드 (Streamlit UI 없음). 앱 파일은 UI만 담당하고 여기서 가져다 씀.
+# 모듈은 프로세스당 한 번만 import되므로 fastai/torch import 비용과 lru_cache가 재실행 간 공유됨.
+import os, re, hashlib
+from io import BytesIO
+from functools import lru_cache
+import numpy as np
+import cv2
+import torch
+from PIL import Image, ImageOps
+from fastai.vision.all import *
+import gdown
+try:
+    import intel_extension_for_pytorch as ipex  # 있으면 bf16(AVX-512 BF16/AMX) 추론
+except ImportError:
+    ipex = None
+
+# ======================
+# 모델 로드
+# ======================
+def configure_torch_threads():
+    torch.set_num_threads(os.cpu_count() or 1)
+    # interop 스레드 수는 프로세스당 한 번만 설정 가능 (모듈이 다시 import돼도 재설정하지 않음)
+    if torch.get_num_interop_threads() == 1: return
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # 이미 설정됐거나 병렬 작업이 시작된 뒤
+
+def cpu_has_native_bf16() -> bool:
+    """AVX-512 BF16 또는 AMX가 있는 CPU인지 (없으면 bf16이 에뮬레이션되어 int8/fp32보다 느림)."""
+    checks = [getattr(torch.cpu, n, None) for n in ("_is_avx512_bf16_supported", "_is_amx_tile_supported")]
+    if any(checks): return any(f() for f in checks if f)
+    return any(k in torch.backends.cpu.get_cpu_capability() for k in ("AVX512", "AMX"))  # 구버전 torch
+
+def sha256_of(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def download_model(file_id: str, output_path: str, sha256: str = ""):
+    """output_path.part에 이어받기 → 체크섬 확인 → 원자적 교체. 다이제스트는 output_path.sha256에 기록."""
+    meta_path = output_path + ".sha256"
+    sha256 = sha256.strip().lower()  # 대문자로 붙여넣은 시크릿도 허용
+    if os.path.exists(output_path):
+        if not sha256: return
+        if not os.path.exists(meta_path):
+            with open(meta_path, "w") as fp: fp.write(sha256_of(output_path))
+        with open(meta_path) as fp:
+            if fp.read().strip().lower() == sha256: return
+    tmp = output_path + ".part"
+    gdown.download(f"https://drive.google.com/uc?id={file_id}", tmp, quiet=False, resume=True)
+    digest = sha256_of(tmp)
+    if sha256 and digest != sha256:
+        os.remove(tmp)
+        raise RuntimeError(f"모델 파일 체크섬 불일치: {digest} (기대값 {sha256})")
+    os.replace(tmp, output_path)
+    with open(meta_path, "w") as fp: fp.write(digest)
+
+def load_model_from_drive(file_id: str, output_path: str, sha256: str = ""):
+    download_model(file_id, output_path, sha256)
+    learner = load_learner(output_path, cpu=True)
+    learner.model.eval()
+    # 추론용 DataLoader는 한 번만 만들고, 파이프라인만 재사용 (predict는 매번 새로 만듦)
+    dummy = PILImage.create(np.zeros((8, 8, 3), dtype=np.uint8))
+    dl = learner.dls.test_dl([dummy], num_workers=0)
+    for nm in ("after_item", "after_batch"):
+        getattr(dl, nm).split_idx = 1  # 검증용 변환만 적용 (iter 없이 직접 호출하므로 수동 설정)
+    # 검증 변환이 Resize(crop/squish)+Normalize뿐이면 fastai 파이프라인 없이 텐서를 직접 만듦
+    tfms = [t for t in (*dl.after_item.fs, *dl.after_batch.fs) if t.split_idx != 0]
+    rs = next((t for t in tfms if isinstance(t, Resize)), None)
+    norm = next((t for t in tfms if isinstance(t, Normalize)), None)
+    # aug_transforms()의 Flip 등 AffineCoordTfm은 검증 시(size 없음) 항등 변환이므로 허용
+    plain = all(isinstance(t, (Resize, ToTensor, IntToFloatTensor, Normalize))
+                or (isinstance(t, AffineCoordTfm) and t.size is None) for t in tfms)
+    learner._resize = rs if plain and rs is not None and rs.method in (ResizeMethod.Crop, ResizeMethod.Squish) else None
+    # 정규화 상수는 브로드캐스트 모양 (1,3,1,1) float32 연속 텐서로 한 번만 만들어 재사용
+    mean, std = (norm.mean, norm.std) if norm is not None else ([0.0] * 3, [1.0] * 3)
+    learner._mean, learner._std = (torch.as_tensor(v).float().cpu().reshape(1, 3, 1, 1).contiguous() for v in (mean, std))
+    # 트레이스용 더미 입력 (크기는 파이프라인 출력 기준)
+    x = dl.after_batch(dl.after_item(dummy)[None]).as_subclass(torch.Tensor)
+    # 모델 입력 크기 (w, h): Resize 설정 우선, 없으면 파이프라인 출력 크기
+    learner._input_size = tuple(rs.size) if rs is not None else (x.shape[-1], x.shape[-2])
+    learner._bf16 = ipex is not None and cpu_has_native_bf16()
+    if learner._bf16:
+        # IPEX + bf16 지원 CPU면 int8 대신 bf16: autocast 상태로 트레이스해서 형 변환까지 그래프에 포함
+        model = ipex.optimize(learner.model, dtype=torch.bfloat16)
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+            learner._scripted = torch.jit.freeze(torch.jit.trace(model, x))
+        return learner, dl
+    # int8 양자화 + TorchScript 변환은 한 번만 하고 파일로 저장
+    # 변환본은 원본 pickle(크기+수정시각)에 묶어 두고, pickle이 바뀌면 다시 만듦
+    int8_path = os.path.splitext(output_path)[0] + "_int8.pt"
+    st_pkl = os.stat(output_path)
+    src_key = f"{st_pkl.st_size}:{st_pkl.st_mtime_ns}"
+    key_path = int8_path + ".src"
+    saved_key = None
+    if os.path.exists(int8_path) and os.path.exists(key_path):
+        with open(key_path) as fp: saved_key = fp.read().strip()
+    if saved_key == src_key:
+        scripted = torch.jit.load(int8_path)
+    else:
+        # Conv2d는 동적 양자화를 지원하지 않으므로 Linear(분류 헤드)만 int8로
+        qmodel = torch.ao.quantization.quantize_dynamic(learner.model, {nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(qmodel, x))
+        torch.jit.save(scripted, int8_path)
+        with open(key_path, "w") as fp: fp.write(src_key)
+    learner._scripted = torch.jit.optimize_for_inference(scripted)
+    return learner, dl
+
+# ======================
+# 전처리/예측
+# ======================
+def load_pil_from_bytes(b: bytes, target: tuple[int, int] | None = None) -> Image.Image:
+    """target (w, h)가 있으면 JPEG는 libjpeg DCT 축소(1/2~1/8)로 디코드 (결과는 target 이상 유지)."""
+    pil = Image.open(BytesIO(b))
+    if target: pil.draft("RGB", (max(target),) * 2)  # EXIF 회전 전이므로 정사각형 기준
+    pil.load()
+    pil = ImageOps.exif_transpose(pil)
+    if pil.mode != "RGB": pil = pil.convert("RGB")
+    return pil
+
+def shrink_to(pil: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """size (w, h)를 덮는 최소 크기로 비율 유지하며 축소 (cv2 INTER_AREA, SIMD). 이미 작으면 그대로."""
+    (w, h), (sw, sh) = pil.size, size
+    scale = max(sw / w, sh / h)
+    if scale >= 1: return pil
+    new_sz = (max(sw, round(w * scale)), max(sh, round(h * scale)))
+    arr = cv2.resize(np.asarray(pil), new_sz, interpolation=cv2.INTER_AREA)
+    return Image.fromarray(arr)
+
+def to_input(learner, pil: Image.Image) -> torch.Tensor:
+    """fastai 검증용 Resize + IntToFloatTensor + Normalize와 같은 결과의 (1,3,H,W) 입력 텐서."""
+    rs = learner._resize
+    (sw, sh), (w, h) = rs.size, pil.size
+    box = (0, 0, w, h)
+    if rs.method == ResizeMethod.Crop:  # 가운데 기준으로 목표 비율만큼 잘라낸 뒤 리사이즈
+        m = min(w / sw, h / sh)
+        cw, ch = int(m * sw), int(m * sh)
+        l, t = int(0.5 * (w - cw)), int(0.5 * (h - ch))
+        box = (l, t, l + cw, t + ch)
+    # resize(box=)는 박스 바깥 픽셀까지 샘플링하므로 fastai처럼 먼저 잘라낸 뒤 리사이즈
+    arr = np.array(pil.crop(box).resize((sw, sh), rs.mode))  # asarray는 읽기 전용이라 torch 경고 발생
+    x = torch.from_numpy(arr).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+    return x.sub_(learner._mean).div_(learner._std)
+
+def predict_probs(learner, dl, pil: Image.Image) -> np.ndarray:
+    """전처리 후 모델 직접 호출 (지원하지 않는 변환 구성이면 캐시된 test_dl 파이프라인). 라벨별 확률 반환."""
+    if learner._resize is not None:
+        x = to_input(learner, pil)
+    else:
+        x = dl.after_batch(dl.after_item(PILImage.create(pil))[None]).as_subclass(torch.Tensor)
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=learner._bf16):
+        probs = learner._scripted(x).float().softmax(-1)[0]
+    return probs.numpy()
+
+DISPLAY_MAX = 1460  # st.image 최대 폭. 더 크면 Streamlit이 EXIF 회전 없이 서버에서 재인코딩함
+
+def display_bytes(b: bytes, max_side: int = DISPLAY_MAX) -> bytes:
+    """화면 표시용 이미지 바이트. 작고 EXIF 회전 태그가 없는 JPEG/PNG면 원본 그대로, 아니면 회전·축소 후 JPEG q85."""
+    pil = Image.open(BytesIO(b))
+    # TIFF/WebP 등은 원본을 넘기면 Streamlit이 매번 PNG로 재인코딩하므로 여기서 한 번 인코딩
+    if (pil.format in ("JPEG", "PNG") and max(pil.size) <= max_side
+            and pil.getexif().get(0x0112, 1) == 1): return b  # 0x0112: Orientation
+    pil = load_pil_from_bytes(b, target=(max_side, max_side))
+    pil.thumbnail((max_side, max_side))
+    buf = BytesIO()
+    pil.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def predict_image(learner, dl, img_bytes: bytes) -> np.ndarray:
+    """이미지 바이트 → 라벨별 확률. 모델 입력 크기로만 디코드·축소한 뒤 예측."""
+    size = learner._input_size
+    return predict_probs(learner, dl, shrink_to(load_pil_from_bytes(img_bytes, target=size), size))
+
+# ======================
+# 유틸
+# ======================
+_YT_PATS = [re.compile(r"(?:v=|/)([0-9A-Za-z_-]{11})(?:\?|&|/|$)"), re.compile(r"youtu\.be/([0-9A-Za-z_-]{11})")]
+
+@lru_cache(maxsize=256)
+def yt_id_from_url(url: str) -> str | None:
+    if not url: return None
+    for p in _YT_PATS:
+        m = p.search(url)
+        if m: return m.group(1)
+    return None
+
+@lru_cache(maxsize=256)
+def yt_thumb(url: str) -> str | None:
+    vid = yt_id_from_url(url)
+    return f"https://img.youtube.com/vi/{vid}/hqdefault.jpg" if vid else None
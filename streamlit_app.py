@@ -1,11 +1,9 @@
 # streamlit_app.py
-import os, re
-from io import BytesIO
+import hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import streamlit as st
-from PIL import Image, ImageOps
-from fastai.vision.all import *
-import gdown
+from pipeline import configure_torch_threads, load_model_from_drive, predict_image, display_bytes, yt_thumb
 
 # ======================
 # 페이지/스타일
@@ -37,8 +35,10 @@ st.title("이미지 분류기 (Fastai) — 확률 막대 + 라벨별 고정 콘
 # ======================
 # 세션 상태
 # ======================
-if "img_bytes" not in st.session_state:
-    st.session_state.img_bytes = None
+if "img_hash" not in st.session_state:
+    st.session_state.img_hash = None
+if "img_file_id" not in st.session_state:
+    st.session_state.img_file_id = None
 if "last_prediction" not in st.session_state:
     st.session_state.last_prediction = None
 
@@ -47,61 +47,65 @@ if "last_prediction" not in st.session_state:
 # ======================
 FILE_ID = st.secrets.get("GDRIVE_FILE_ID", "1cdbz-r9kShijyDwG8fujdaDUpwc_R0bq7")
 MODEL_PATH = st.secrets.get("MODEL_PATH", "model.pkl")
+MODEL_SHA256 = st.secrets.get("MODEL_SHA256", "")  # 비우면 체크섬 검사 생략
+MODEL_KEY = (FILE_ID, MODEL_PATH, MODEL_SHA256)  # model_future와 같은 키: 모델에서 파생된 캐시에 함께 넘김
 
 @st.cache_resource
-def load_model_from_drive(file_id: str, output_path: str):
-    if not os.path.exists(output_path):
-        url = f"https://drive.google.com/uc?id={file_id}"
-        gdown.download(url, output_path, quiet=False)
-    return load_learner(output_path, cpu=True)
+def model_future(file_id: str, output_path: str, sha256: str = ""):
+    """모델 다운로드+로드를 백그라운드 스레드에서 시작 (그동안 입력 UI가 먼저 그려짐)."""
+    ex = ThreadPoolExecutor(max_workers=1)
+    fut = ex.submit(load_model_from_drive, file_id, output_path, sha256)
+    ex.shutdown(wait=False)
+    return fut
 
-with st.spinner("🤖 모델 로드 중..."):
-    learner = load_model_from_drive(FILE_ID, MODEL_PATH)
-st.success("✅ 모델 로드 완료")
+@st.cache_resource
+def get_labels(model_key: tuple, _learner):
+    """vocab 문자열 변환은 모델당 한 번만. (목록, 인덱싱용 배열) 반환."""
+    labels = [str(x) for x in _learner.dls.vocab]
+    return labels, np.array(labels)
 
-labels = [str(x) for x in learner.dls.vocab]
-st.write(f"**분류 가능한 항목:** `{', '.join(labels)}`")
-st.markdown("---")
+configure_torch_threads()
+fut = model_future(*MODEL_KEY)
+model_status = st.container()  # 모델 준비 후 로드 완료/라벨 목록을 이 자리에 표시
 
 # ======================
-# 라벨 이름 매핑: 여기를 채우세요!
-# 각 라벨당 최대 3개씩 표시됩니다.
+# 유틸
 # ======================
-CONTENT_BY_LABEL: dict[str, dict[str, list[str]]] = {
-    # 예)
-    # "짬뽕": {
-    #   "texts": ["짬뽕의 특징과 유래", "국물 맛 포인트", "지역별 스타일 차이"],
-    #   "images": ["https://.../jjampong1.jpg", "https://.../jjampong2.jpg"],
-    #   "videos": ["https://youtu.be/XXXXXXXXXXX"]
-    # },
-}
-labels[0] : {"texts" : ["중국식 냉면은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A4%91%EA%B5%AD%EC%8B%9D%20%EB%83%89%EB%A9%B4&imgurl=https%3A%2F%2Fwww.unileverfoodsolutions.co.kr%2Fdam%2Fglobal-ufs%2Fmcos%2Fsouth-korea%2Fcalcmenu%2Frecipes%2Fkr-recipes%2Fchinese%2Fheader%2F%25EC%25A4%2591%25EA%25B5%25AD%25EB%2583%2589%25EB%25A9%25B4-chinese-cold-noodles-header-1260x709px.jpg&imgrefurl=https%3A%2F%2Fwww.unileverfoodsolutions.co.kr%2Frecipe%2F%25EC%25A4%2591%25EA%25B5%25AD-%25EB%2583%2589%25EB%25A9%25B4-R9008730.html&docid=GRP6jBwOviJAsM&tbnid=M5izEZquh8Kc5M&vet=12ahUKEwj034D5wo6RAxW2sFYBHVa-Go8QM3oECBcQAA..i&w=1260&h=709&hcb=2&ved=2ahUKEwj034D5wo6RAxW2sFYBHVa-Go8QM3oECBcQAA"]}
-labels[1] : {"texts" : ["짜장면은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A7%9C%EC%9E%A5%EB%A9%B4&imgurl=https%3A%2F%2Fi.namu.wiki%2Fi%2Fj2AxLP9AtrcJebh4DVfGxowfXwI3a95dG_YZb_Ktczc6Ca7ACyd_NJL3YHQMw8SABGTQiJDwSpySOSSBLZVEZw.webp&imgrefurl=https%3A%2F%2Fnamu.wiki%2Fw%2F%25EC%25A7%259C%25EC%259E%25A5%25EB%25A9%25B4&docid=ta-WQ3Mh4wWyyM&tbnid=yfkV9HWc_n9W7M&vet=12ahUKEwi245vPw46RAxUwma8BHdLOOzgQM3oECBkQAA..i&w=1000&h=750&hcb=2&ved=2ahUKEwi245vPw46RAxUwma8BHdLOOzgQM3oECBkQAA"]}
-labels[2] : {"texts" : ["짬뽕은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A7%AC%EB%BD%95&imgurl=https%3A%2F%2Frecipe1.ezmember.co.kr%2Fcache%2Frecipe%2F2023%2F09%2F28%2F508b7b33d78930782020c04e793a1b251.jpg&imgrefurl=https%3A%2F%2Fwww.10000recipe.com%2Frecipe%2F7010631%3Fsrsltid%3DAfmBOoqSS98QS5IBWL-OQwoZ9S4uqiun-Y9SX-6VUnaoMIN-ouFN1BfK&docid=04HWkJr3mc8HKM&tbnid=YG95ojU9bexAHM&vet=12ahUKEwjpievfw46RAxWWavUHHcALEoIQM3oECB0QAA..i&w=1411&h=1058&hcb=2&ved=2ahUKEwjpievfw46RAxWWavUHHcALEoIQM3oECB0QAA"]}
-labels[3] : {"texts" : ["탕수육은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%ED%83%95%EC%88%98%EC%9C%A1&imgurl=https%3A%2F%2Frecipe1.ezmember.co.kr%2Fcache%2Frecipe%2F2018%2F07%2F12%2F12221690d4f7dc3e0bbdc70d05017b101.jpg&imgrefurl=https%3A%2F%2Fwww.10000recipe.com%2Frecipe%2F6892414%3Fsrsltid%3DAfmBOor-mzvvdICJdPbQq7NmTvfdZc9HLN7gbNRUPT67NFjR3qeCRMJN&docid=55vxmA_T3dbFBM&tbnid=sxSdWI986D9IDM&vet=12ahUKEwjS8_nqw46RAxU2ia8BHdOZMUkQM3oECBwQAA..i&w=1500&h=1125&hcb=2&ved=2ahUKEwjS8_nqw46RAxU2ia8BHdOZMUkQM3oECBwQAA"]}
+IMAGE_STORE_MAX_BYTES = 256 * 1024 * 1024  # 프로세스 전체 이미지 보관 한도 (초과 시 오래 안 쓴 것부터 버림)
 
+@st.cache_resource
+def image_store():
+    """내용 해시 → 이미지 바이트. 세션/재실행 간 공유되어 같은 이미지는 한 벌만 보관."""
+    return {}, threading.Lock()
 
-             
-# ======================
-# 유틸
-# ======================
-def load_pil_from_bytes(b: bytes) -> Image.Image:
-    pil = Image.open(BytesIO(b))
-    pil = ImageOps.exif_transpose(pil)
-    if pil.mode != "RGB": pil = pil.convert("RGB")
-    return pil
+def put_image(b: bytes) -> str:
+    h = hashlib.blake2b(b, digest_size=16).hexdigest()
+    store, lock = image_store()
+    with lock:
+        store[h] = store.pop(h, b)
+        total = sum(map(len, store.values()))
+        while total > IMAGE_STORE_MAX_BYTES and len(store) > 1:  # 방금 넣은 이미지는 항상 유지
+            total -= len(store.pop(next(iter(store))))
+    return h
 
-def yt_id_from_url(url: str) -> str | None:
-    if not url: return None
-    pats = [r"(?:v=|/)([0-9A-Za-z_-]{11})(?:\?|&|/|$)", r"youtu\.be/([0-9A-Za-z_-]{11})"]
-    for p in pats:
-        m = re.search(p, url)
-        if m: return m.group(1)
-    return None
+def get_image(h: str | None) -> bytes | None:
+    if not h: return None
+    store, lock = image_store()
+    with lock:
+        b = store.pop(h, None)
+        if b is not None: store[h] = b  # 최근 사용으로 갱신
+    return b
 
-def yt_thumb(url: str) -> str | None:
-    vid = yt_id_from_url(url)
-    return f"https://img.youtube.com/vi/{vid}/hqdefault.jpg" if vid else None
+@st.cache_data(show_spinner=False, max_entries=32)
+def predict_cached(model_key: tuple, img_hash: str, _img_bytes: bytes):
+    """모델 키 + 이미지 내용 해시 기준으로 디코드+예측 결과 캐시 (바이트 자체는 해싱하지 않음). (예측 라벨, 확률) 반환."""
+    probs = predict_image(learner, test_dl, _img_bytes)
+    return labels[int(probs.argmax())], probs
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def display_cached(img_hash: str, _img_bytes: bytes) -> bytes:
+    """이미지 해시별 화면 표시용 바이트 (회전·축소·JPEG 인코딩은 이미지당 한 번, 불변이라 복사 없이 공유)."""
+    return display_bytes(_img_bytes)
 
 def pick_top3(lst):
     return [x for x in lst if isinstance(x, str) and x.strip()][:3]
@@ -115,39 +119,83 @@ def get_content_for_label(label: str):
         pick_top3(cfg.get("videos", [])),
     )
 
+def emit_grid(cards):
+    """카드 HTML들을 info-grid 하나로 묶어 한 번의 st.markdown으로 전송."""
+    st.markdown(f'<div class="info-grid">{"".join(cards)}</div>', unsafe_allow_html=True)
+
 # ======================
 # 입력(카메라/업로드)
 # ======================
 tab_cam, tab_file = st.tabs(["📷 카메라로 촬영", "📁 파일 업로드"])
-new_bytes = None
+src = None
 
 with tab_cam:
     cam = st.camera_input("카메라 스냅샷", label_visibility="collapsed")
     if cam is not None:
-        new_bytes = cam.getvalue()
+        src = cam
 
 with tab_file:
     f = st.file_uploader("이미지를 업로드하세요 (jpg, png, jpeg, webp, tiff)",
                          type=["jpg","png","jpeg","webp","tiff"])
     if f is not None:
-        new_bytes = f.getvalue()
+        src = f
 
-if new_bytes:
-    st.session_state.img_bytes = new_bytes
+# 위젯의 파일이 바뀐 경우에만 바이트 복사 (재실행마다 getvalue() 복사 방지)
+if src is not None and src.file_id != st.session_state.img_file_id:
+    b = src.getvalue()
+    st.session_state.img_hash = put_image(b) if b else None
+    st.session_state.img_file_id = src.file_id
+
+img_bytes = get_image(st.session_state.img_hash)
+if img_bytes is None and src is not None:
+    # 저장소에서 밀려났지만 위젯에 파일이 남아 있으면 다시 저장 (다시 업로드할 필요 없음)
+    img_bytes = src.getvalue() or None
+    if img_bytes: st.session_state.img_hash = put_image(img_bytes)
+
+# ======================
+# 모델 준비 대기 (입력 위젯이 먼저 그려진 뒤)
+# ======================
+with model_status:
+    with st.spinner("🤖 모델 로드 중..."):
+        try:
+            learner, test_dl = fut.result()
+        except Exception:
+            model_future.clear()  # 실패한 로드는 캐시하지 않고 다음 실행에서 재시도
+            raise
+    st.success("✅ 모델 로드 완료")
+    labels, labels_arr = get_labels(MODEL_KEY, learner)
+    st.write(f"**분류 가능한 항목:** `{', '.join(labels)}`")
+    st.markdown("---")
+
+# ======================
+# 라벨 이름 매핑: 여기를 채우세요!
+# 각 라벨당 최대 3개씩 표시됩니다.
+# ======================
+CONTENT_BY_LABEL: dict[str, dict[str, list[str]]] = {
+    # 예)
+    # "짬뽕": {
+    #   "texts": ["짬뽕의 특징과 유래", "국물 맛 포인트", "지역별 스타일 차이"],
+    #   "images": ["https://.../jjampong1.jpg", "https://.../jjampong2.jpg"],
+    #   "videos": ["https://youtu.be/XXXXXXXXXXX"]
+    # },
+}
+labels[0] : {"texts" : ["중국식 냉면은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A4%91%EA%B5%AD%EC%8B%9D%20%EB%83%89%EB%A9%B4&imgurl=https%3A%2F%2Fwww.unileverfoodsolutions.co.kr%2Fdam%2Fglobal-ufs%2Fmcos%2Fsouth-korea%2Fcalcmenu%2Frecipes%2Fkr-recipes%2Fchinese%2Fheader%2F%25EC%25A4%2591%25EA%25B5%25AD%25EB%2583%2589%25EB%25A9%25B4-chinese-cold-noodles-header-1260x709px.jpg&imgrefurl=https%3A%2F%2Fwww.unileverfoodsolutions.co.kr%2Frecipe%2F%25EC%25A4%2591%25EA%25B5%25AD-%25EB%2583%2589%25EB%25A9%25B4-R9008730.html&docid=GRP6jBwOviJAsM&tbnid=M5izEZquh8Kc5M&vet=12ahUKEwj034D5wo6RAxW2sFYBHVa-Go8QM3oECBcQAA..i&w=1260&h=709&hcb=2&ved=2ahUKEwj034D5wo6RAxW2sFYBHVa-Go8QM3oECBcQAA"]}
+labels[1] : {"texts" : ["짜장면은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A7%9C%EC%9E%A5%EB%A9%B4&imgurl=https%3A%2F%2Fi.namu.wiki%2Fi%2Fj2AxLP9AtrcJebh4DVfGxowfXwI3a95dG_YZb_Ktczc6Ca7ACyd_NJL3YHQMw8SABGTQiJDwSpySOSSBLZVEZw.webp&imgrefurl=https%3A%2F%2Fnamu.wiki%2Fw%2F%25EC%25A7%259C%25EC%259E%25A5%25EB%25A9%25B4&docid=ta-WQ3Mh4wWyyM&tbnid=yfkV9HWc_n9W7M&vet=12ahUKEwi245vPw46RAxUwma8BHdLOOzgQM3oECBkQAA..i&w=1000&h=750&hcb=2&ved=2ahUKEwi245vPw46RAxUwma8BHdLOOzgQM3oECBkQAA"]}
+labels[2] : {"texts" : ["짬뽕은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%EC%A7%AC%EB%BD%95&imgurl=https%3A%2F%2Frecipe1.ezmember.co.kr%2Fcache%2Frecipe%2F2023%2F09%2F28%2F508b7b33d78930782020c04e793a1b251.jpg&imgrefurl=https%3A%2F%2Fwww.10000recipe.com%2Frecipe%2F7010631%3Fsrsltid%3DAfmBOoqSS98QS5IBWL-OQwoZ9S4uqiun-Y9SX-6VUnaoMIN-ouFN1BfK&docid=04HWkJr3mc8HKM&tbnid=YG95ojU9bexAHM&vet=12ahUKEwjpievfw46RAxWWavUHHcALEoIQM3oECB0QAA..i&w=1411&h=1058&hcb=2&ved=2ahUKEwjpievfw46RAxWWavUHHcALEoIQM3oECB0QAA"]}
+labels[3] : {"texts" : ["탕수육은 맛있어"], "imges" : ["https://www.google.com/imgres?q=%ED%83%95%EC%88%98%EC%9C%A1&imgurl=https%3A%2F%2Frecipe1.ezmember.co.kr%2Fcache%2Frecipe%2F2018%2F07%2F12%2F12221690d4f7dc3e0bbdc70d05017b101.jpg&imgrefurl=https%3A%2F%2Fwww.10000recipe.com%2Frecipe%2F6892414%3Fsrsltid%3DAfmBOor-mzvvdICJdPbQq7NmTvfdZc9HLN7gbNRUPT67NFjR3qeCRMJN&docid=55vxmA_T3dbFBM&tbnid=sxSdWI986D9IDM&vet=12ahUKEwjS8_nqw46RAxU2ia8BHdOZMUkQM3oECBwQAA..i&w=1500&h=1125&hcb=2&ved=2ahUKEwjS8_nqw46RAxU2ia8BHdOZMUkQM3oECBwQAA"]}
 
 # ======================
 # 예측 & 레이아웃
 # ======================
-if st.session_state.img_bytes:
+if img_bytes:
     top_l, top_r = st.columns([1, 1], vertical_alignment="center")
 
-    pil_img = load_pil_from_bytes(st.session_state.img_bytes)
     with top_l:
-        st.image(pil_img, caption="입력 이미지", use_container_width=True)
+        st.image(display_cached(st.session_state.img_hash, img_bytes), caption="입력 이미지", use_container_width=True)
 
     with st.spinner("🧠 분석 중..."):
-        pred, pred_idx, probs = learner.predict(PILImage.create(np.array(pil_img)))
-        st.session_state.last_prediction = str(pred)
+        pred, probs = predict_cached(MODEL_KEY, st.session_state.img_hash, img_bytes)
+        st.session_state.last_prediction = pred
 
     with top_r:
         st.markdown(
@@ -162,28 +210,20 @@ if st.session_state.img_bytes:
 
     left, right = st.columns([1,1], vertical_alignment="top")
 
-    # 왼쪽: 확률 막대
+    # 왼쪽: 확률 막대 (카드 전체를 한 번의 st.markdown으로 전송)
     with left:
         st.subheader("상세 예측 확률")
-        prob_list = sorted(
-            [(labels[i], float(probs[i])) for i in range(len(labels))],
-            key=lambda x: x[1], reverse=True
-        )
-        for lbl, p in prob_list:
-            pct = p * 100
-            hi = "highlight" if lbl == st.session_state.last_prediction else ""
-            st.markdown(
-                f"""
-                <div class="prob-card">
-                  <div style="display:flex;justify-content:space-between;margin-bottom:6px;">
-                    <strong>{lbl}</strong><span>{pct:.2f}%</span>
-                  </div>
-                  <div class="prob-bar-bg">
-                    <div class="prob-bar-fg {hi}" style="width:{pct:.4f}%;"></div>
-                  </div>
-                </div>
-                """, unsafe_allow_html=True
-            )
+        order = np.argsort(-probs)
+        prob_list = list(zip(labels_arr[order].tolist(), probs[order].tolist()))
+        st.markdown("".join(
+            f'<div class="prob-card">'
+            f'<div style="display:flex;justify-content:space-between;margin-bottom:6px;">'
+            f'<strong>{lbl}</strong><span>{p * 100:.2f}%</span></div>'
+            f'<div class="prob-bar-bg"><div class="prob-bar-fg {"highlight" if lbl == st.session_state.last_prediction else ""}" '
+            f'style="width:{p * 100:.4f}%;"></div></div>'
+            f'</div>'
+            for lbl, p in prob_list
+        ), unsafe_allow_html=True)
 
     # 오른쪽: 정보 패널 (예측 라벨 기본, 다른 라벨로 바꿔보기 가능)
     with right:
@@ -198,50 +238,34 @@ if st.session_state.img_bytes:
         else:
             # 텍스트
             if texts:
-                st.markdown('<div class="info-grid">', unsafe_allow_html=True)
-                for t in texts:
-                    st.markdown(f"""
-                    <div class="card" style="grid-column:span 12;">
-                      <h4>텍스트</h4>
-                      <div>{t}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                st.markdown('</div>', unsafe_allow_html=True)
+                emit_grid(
+                    f'<div class="card" style="grid-column:span 12;"><h4>텍스트</h4><div>{t}</div></div>'
+                    for t in texts
+                )
 
             # 이미지(최대 3, 3열)
             if images:
-                st.markdown('<div class="info-grid">', unsafe_allow_html=True)
-                for url in images[:3]:
-                    st.markdown(f"""
-                    <div class="card" style="grid-column:span 4;">
-                      <h4>이미지</h4>
-                      <img src="{url}" class="thumb" />
-                    </div>
-                    """, unsafe_allow_html=True)
-                st.markdown('</div>', unsafe_allow_html=True)
+                emit_grid(
+                    f'<div class="card" style="grid-column:span 4;"><h4>이미지</h4><img src="{url}" class="thumb" /></div>'
+                    for url in images[:3]
+                )
 
             # 동영상(유튜브 썸네일)
             if videos:
-                st.markdown('<div class="info-grid">', unsafe_allow_html=True)
+                cards = []
                 for v in videos[:3]:
                     thumb = yt_thumb(v)
                     if thumb:
-                        st.markdown(f"""
-                        <div class="card" style="grid-column:span 6;">
-                          <h4>동영상</h4>
-                          <a href="{v}" target="_blank" class="thumb-wrap">
-                            <img src="{thumb}" class="thumb"/>
-                            <div class="play"></div>
-                          </a>
-                          <div class="helper">{v}</div>
-                        </div>
-                        """, unsafe_allow_html=True)
+                        cards.append(
+                            f'<div class="card" style="grid-column:span 6;"><h4>동영상</h4>'
+                            f'<a href="{v}" target="_blank" class="thumb-wrap"><img src="{thumb}" class="thumb"/><div class="play"></div></a>'
+                            f'<div class="helper">{v}</div></div>'
+                        )
                     else:
-                        st.markdown(f"""
-                        <div class="card" style="grid-column:span 6;">
-                          <h4>동영상</h4>
-                          <a href="{v}" target="_blank">{v}</a>
-                        </div>
-                        """, unsafe_allow_html=True)
+                        cards.append(
+                            f'<div class="card" style="grid-column:span 6;"><h4>동영상</h4>'
+                            f'<a href="{v}" target="_blank">{v}</a></div>'
+                        )
+                emit_grid(cards)
 else:
     st.info("카메라로 촬영하거나 파일을 업로드하면 분석 결과와 라벨별 콘텐츠가 표시됩니다.")